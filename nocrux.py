@@ -22,19 +22,28 @@ __author__ = 'Niklas Rosenstein <rosensteinniklas@gmail.com>'
 __version__ = '2.0.3'
 
 import argparse
+import asyncio
+import bisect
 import collections
 import errno
+import fnmatch
 import glob
+import heapq
 import nr.parse.strex as strex
 import os
+import pickle
 import pwd, grp
+import re
 import runpy
+import select
 import shlex
 import signal
+import socket
 import string
 import subprocess
 import sys
 import textwrap
+import threading
 import time
 import types
 from operator import attrgetter
@@ -42,13 +51,22 @@ from operator import attrgetter
 USER_CONFIG_FILE = os.path.expanduser('~/.nocrux/conf')
 ROOT_CONFIG_FILE = os.path.expanduser('/etc/nocrux/conf')
 ROOT_CONFIG_ROOT = '/var/run/nocrux'
-AVAILABLE_DAEMON_COMMANDS = ('start', 'stop', 'restart', 'status', 'pid', 'cat', 'tail')
+AVAILABLE_DAEMON_COMMANDS = ('start', 'stop', 'restart', 'status', 'pid', 'cat', 'tail', 'logs')
+LOG_INDEX_INTERVAL = 64 * 1024
+TIMESTAMP_REGEX = re.compile(br'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.\d{3}Z ')
+TIMESTAMP_LENGTH = 24
 config = {
   'root': os.path.expanduser('~/.nocrux/run'),
-  'kill_timeout': 10
+  'kill_timeout': 10,
+  'watchdog_misses': 3,
+  'watchdog_max_backoff': 300
 }
 daemons = {}
 
+# Set the ``messages`` attribute to a list to capture the messages of
+# :meth:`Daemon.log` in the current thread instead of printing them.
+log_capture = threading.local()
+
 
 def abspath(path, root=None):
   ''' Make *path* absolute if it not already is. Relative paths
@@ -94,18 +112,220 @@ def process_exists(pid):
   return True
 
 
+def format_timestamp(t):
+  ''' Formats the Unix timestamp *t* as a fixed-width UTC timestamp string
+  that is used to prefix lines in timestamped log files. Because of the fixed
+  width, these strings can be compared without parsing them. '''
+
+  millis = int(t * 1000) % 1000
+  return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(t)) + '.{:03d}Z'.format(millis)
+
+
+def parse_time(value, now=None):
+  ''' Parses a point in time as accepted by the ``--since`` and ``--until``
+  command-line options and returns it as a string in the format of
+  :func:`format_timestamp`. *value* can be a duration relative to *now*
+  (eg. ``30s``, ``10m``, ``2h`` or ``1d``) or an absolute local time in
+  the format ``YYYY-MM-DD[ HH:MM[:SS]]``. '''
+
+  if now is None:
+    now = time.time()
+  match = re.match(r'^(\d+(?:\.\d+)?)([smhd])$', value.strip())
+  if match:
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    return format_timestamp(now - float(match.group(1)) * units[match.group(2)])
+  for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+    try:
+      return format_timestamp(time.mktime(time.strptime(value.strip(), fmt)))
+    except ValueError:
+      pass
+  raise ValueError('invalid time: {!r}'.format(value))
+
+
+def index_filename(filename):
+  ''' Returns the name of the sparse index file for the log *filename*. '''
+
+  return filename + '.idx'
+
+
+class TimestampedLog(object):
+  ''' Appends lines to the log file *filename*, prefixing every line with
+  a timestamp (see :func:`format_timestamp`). Every *interval* bytes, the
+  timestamp and file offset of the next line is recorded in the index file
+  next to the log (see :func:`index_filename`), which allows
+  :func:`read_log` to seek close to a point in time without scanning the
+  whole log. '''
+
+  def __init__(self, filename, interval=LOG_INDEX_INTERVAL):
+    self.filename = filename
+    self.interval = interval
+    self._lock = threading.Lock()
+    self._fp = open(filename, 'ab')
+    self._index = open(index_filename(filename), 'a')
+    self._last_offset = None
+
+  def write(self, line):
+    ''' Writes a single line (bytes) to the log file. '''
+
+    if not line.endswith(b'\n'):
+      line += b'\n'
+    with self._lock:
+      stamp = format_timestamp(time.time())
+      # Other processes may append to the same file (eg. the nocrux log
+      # messages), thus we can not rely on our own file position.
+      offset = os.fstat(self._fp.fileno()).st_size
+      # The log has been truncated (eg. by logrotate with copytruncate),
+      # the existing index entries do not apply anymore.
+      if self._last_offset is not None and offset < self._last_offset:
+        self._index.truncate(0)
+        self._last_offset = None
+      if self._last_offset is None or offset - self._last_offset >= self.interval:
+        self._index.write('{} {}\n'.format(stamp, offset))
+        self._index.flush()
+        self._last_offset = offset
+      self._fp.write(stamp.encode('ascii') + b' ' + line)
+      self._fp.flush()
+
+  def capture(self, pipe):
+    ''' Starts a thread that writes every line read from *pipe* to the log
+    file until the pipe is closed. Returns the thread. '''
+
+    def worker():
+      for line in iter(pipe.readline, b''):
+        self.write(line)
+      pipe.close()
+    thread = threading.Thread(target=worker)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def read_index(filename, since):
+  ''' Reads the index of the log *filename* and returns the offset of the
+  latest indexed line that was logged before *since*. Returns 0 if there
+  is no index or no such line, or if the index does not match the log. '''
+
+  try:
+    size = os.path.getsize(filename)
+    with open(index_filename(filename)) as fp:
+      entries = []
+      for line in fp:
+        stamp, __, offset = line.strip().partition(' ')
+        if offset.isdigit() and int(offset) <= size:
+          entries.append((stamp, int(offset)))
+  except OSError as exc:
+    if exc.errno != errno.ENOENT:
+      raise
+    return 0
+
+  # Lines logged in the same millisecond as *since* may precede the entry
+  # with that exact timestamp, so we only consider strictly older entries.
+  entries.sort()
+  index = bisect.bisect_left(entries, (since,)) - 1
+  if index < 0:
+    return 0
+
+  # The index is outdated if the log has been truncated or replaced.
+  stamp, offset = entries[index]
+  with open(filename, 'rb') as fp:
+    fp.seek(offset)
+    if fp.read(TIMESTAMP_LENGTH) != stamp.encode('ascii'):
+      return 0
+  return offset
+
+
+def read_log(filename, since=None, until=None, pattern=None):
+  ''' Generator for the ``(timestamp, line)`` pairs in the timestamped log
+  file *filename* that were logged in the range from *since* (inclusive)
+  to *until* (exclusive) and that match the compiled regular expression
+  *pattern*. Lines without a timestamp (eg. messages from nocrux itself)
+  are attributed to the timestamp of the line before them. '''
+
+  try:
+    fp = open(filename, 'rb')
+  except OSError as exc:
+    if exc.errno != errno.ENOENT:
+      raise
+    return
+
+  with fp:
+    if since:
+      fp.seek(read_index(filename, since))
+    stamp = ''
+    for line in fp:
+      if TIMESTAMP_REGEX.match(line):
+        stamp = line[:TIMESTAMP_LENGTH].decode('ascii')
+        line = line[TIMESTAMP_LENGTH + 1:]
+      if since and stamp < since:
+        continue
+      if until and stamp >= until:
+        break
+      line = line.decode('utf8', 'replace').rstrip('\n')
+      if pattern and not pattern.search(line):
+        continue
+      yield stamp, line
+
+
+def search_logs(selected, since=None, until=None, pattern=None):
+  ''' Searches the timestamped logs of all daemons in *selected* and yields
+  ``(timestamp, label, line)`` tuples merged in time order. The label is the
+  daemon name, with an ``:err`` suffix for lines from a separate standard
+  error output file. Daemons that do not have timestamps enabled are skipped,
+  logs that can not be read are reported with :meth:`Daemon.log`. '''
+
+  def labeled(daemon, label, filename):
+    try:
+      for stamp, line in read_log(filename, since, until, pattern):
+        yield stamp, label, line
+    except OSError as exc:
+      daemon.log('could not read log "{}": {}'.format(filename, exc), file=sys.stderr)
+
+  streams = []
+  for daemon in selected:
+    if not daemon.timestamps:
+      continue
+    streams.append(labeled(daemon, daemon.name, daemon.stdout))
+    if daemon.stderr:
+      streams.append(labeled(daemon, daemon.name + ':err', daemon.stderr))
+  return heapq.merge(*streams)
+
+
+def select_daemons(selector):
+  ''' Returns a list of the daemons matched by *selector*, which is a comma
+  separated list of daemon names or glob patterns. The special name ``all``
+  matches all daemons. Raises a :class:`ValueError` if a name does not match
+  any daemon. '''
+
+  result = []
+  for name in selector.split(','):
+    name = name.strip()
+    if name == 'all':
+      name = '*'
+    matches = sorted(fnmatch.filter(daemons, name))
+    if not matches:
+      raise ValueError('no such daemon: {}'.format(name))
+    result.extend(daemons[x] for x in matches if daemons[x] not in result)
+  return result
+
+
 class Daemon(object):
   ''' Configuration for a daemon process. '''
 
   Status_Started = 'started'
   Status_Stopped = 'stopped'
+  WatchdogState = collections.namedtuple('WatchdogState', 'missed restarts')
 
   def __init__(
       self, name, prog, root=None, args=(), cwd=None, user=None, group=None,
       stdin=None, stdout=None, stderr=None, pidfile=None, requires=None,
-      env=None, sigterm=None, sigkill=None, commands=None):
+      env=None, sigterm=None, sigkill=None, commands=None, timestamps=False,
+      watchdog=None, watchdog_probe=None, notify_socket=None, watchdog_file=None):
     if not pidfile:
       pidfile = abspath(name + '.pid', root)
+    if not notify_socket:
+      notify_socket = abspath(name + '.sock', root)
+    if not watchdog_file:
+      watchdog_file = abspath(name + '.watchdog', root)
     if stdout is None:
       stdout = abspath(name + '.out', root)
 
@@ -115,6 +335,7 @@ class Daemon(object):
       raise ValueError('daemon can not require itself')
 
     self._log_newline = True
+    self._lock = threading.RLock()
     self.name = name
     self.prog = prog
     self.args = list(args)
@@ -130,10 +351,25 @@ class Daemon(object):
     self.sigkill = signal.SIGKILL if sigkill is None else sigkill
     self.commands = {} if commands is None else commands
     self.env = {} if env is None else env
+    self.timestamps = timestamps
+    self.watchdog = watchdog
+    self.watchdog_probe = watchdog_probe
+    self.notify_socket = notify_socket
+    self.watchdog_file = watchdog_file
+    self.stop_file = watchdog_file + '.stop'
 
   def __repr__(self):
     return '<Daemon {!r}: {}>'.format(self.name, self.status)
 
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    del state['_lock']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._lock = threading.RLock()
+
   @property
   def pid(self):
     ''' Returns the PID of the daemon. It is read from the file
@@ -164,9 +400,47 @@ class Daemon(object):
     else:
       return self.Status_Stopped
 
+  @property
+  def watchdog_state(self):
+    ''' Returns a :class:`WatchdogState` with the number of heartbeats that
+    the daemon has missed in a row and the number of times it has been
+    restarted by the watchdog. Both are zero if the daemon has not been
+    started with a watchdog. '''
+
+    try:
+      with open(self.watchdog_file, 'r') as fp:
+        parts = fp.readline().split()
+    except OSError as exc:
+      if exc.errno != errno.ENOENT:
+        raise
+      parts = []
+
+    try:
+      return self.WatchdogState(*map(int, parts[:2]))
+    except (TypeError, ValueError):
+      return self.WatchdogState(0, 0)
+
+  def command_env(self):
+    ''' Returns the environment for custom daemon commands and the
+    watchdog probe command. '''
+
+    env = os.environ.copy()
+    env.update(self.env)
+    env['DAEMON_PID'] = str(self.pid)
+    env['DAEMON_PIDFILE'] = self.pidfile
+    env['DAEMON_STDOUT'] = self.stdout
+    env['DAEMON_STDERR'] = self.stderr or ''
+    return env
+
   def log(self, *message, **kwargs):
-    ''' Prints a message with the name of the daemon as its prefix. '''
+    ''' Prints a message with the name of the daemon as its prefix. If
+    messages are captured in the current thread (see :data:`log_capture`),
+    the message is appended to the captured messages instead. '''
 
+    messages = getattr(log_capture, 'messages', None)
+    if messages is not None:
+      messages.append((self.name, ' '.join(map(str, message))))
+      return
     if self._log_newline:
       print('[nocrux]: ({0})'.format(self.name), *message, **kwargs)
     else:
@@ -179,6 +453,12 @@ class Daemon(object):
     if the daemon is already running or could be started, False if
     it could not be started. '''
 
+    # Prevent starting the daemon twice when it is started from multiple
+    # threads at once (eg. as a requirement of other daemons).
+    with self._lock:
+      return self._start()
+
+  def _start(self):
     if self.status == self.Status_Started:
       self.log('daemon already started')
       return True
@@ -202,18 +482,49 @@ class Daemon(object):
       record = grp.getgrnam(self.group)
       gid = record.gr_gid
 
-    # Fork so we can detach from the parent process etc. The parent
-    # will wait for a little time to check if the process has started.
-    pid = os.fork()
-    if pid > 0:
-      time.sleep(0.20)
-      pid = self.pid
-      if process_exists(pid):
-        self.log('started. (pid: {0})'.format(pid))
-      else:
-        cmd = 'tail:err' if self.stderr else 'tail'
-        self.log('could not be started. try "nocrux {} {}"'.format(self.name, cmd))
+    # Start the supervisor in a new process instead of forking, as the
+    # caller may run other threads (eg. when using the asyncio API). The
+    # daemon and the configuration are passed through its standard input.
+    # It forks once more and exits (see :func:`run_supervisor`), then we
+    # wait for a little time to check if the process has started.
+    messages = getattr(log_capture, 'messages', None)
+    output = None if messages is None else subprocess.PIPE
+
+    # The supervisor must be able to import the same modules as we do (eg.
+    # when the dependencies are installed by Node.py), thus we pass our
+    # search path. The original PYTHONPATH is restored for the daemon.
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.pathsep.join(os.path.abspath(x) for x in sys.path)
+    pythonpath = os.environ.get('PYTHONPATH')
+
+    supervisor = subprocess.Popen(
+      [sys.executable, os.path.abspath(__file__), '--supervise'],
+      stdin=subprocess.PIPE, stdout=output, stderr=subprocess.STDOUT, env=env,
+      start_new_session=True)
+    out, __ = supervisor.communicate(pickle.dumps(
+      (self.__getstate__(), config, pythonpath, home, uid, gid)))
+
+    # When capturing messages, add the output of the supervisor up to the
+    # point where it redirects its output to the daemon's output files.
+    if messages is not None:
+      for line in out.decode('utf8', 'replace').splitlines():
+        match = re.match(r'^\[nocrux\]: \((.*?)\) (.*)$', line)
+        if match:
+          messages.append(match.groups())
+        elif line.strip():
+          messages.append((self.name, line))
+    time.sleep(0.20)
+    pid = self.pid
+    if process_exists(pid):
+      self.log('started. (pid: {0})'.format(pid))
       return True
+    cmd = 'tail:err' if self.stderr else 'tail'
+    self.log('could not be started. try "nocrux {} {}"'.format(self.name, cmd))
+    return False
+
+  def _run(self, home, uid, gid):
+    ''' Runs the daemon process in the supervisor process and waits for
+    it to exit. Exits the current process. '''
 
     # Make sure the directory of the PID and output files exist.
     makedirs(os.path.dirname(self.pidfile))
@@ -221,8 +532,7 @@ class Daemon(object):
     makedirs(os.path.dirname(self.stdout))
     makedirs(os.path.dirname(self.stderr or self.stdout))
 
-    # Detach the process and set the user and group IDs if applicable.
-    os.setsid()
+    # Set the user and group IDs if applicable.
     if uid is not None:
       try:
         os.setuid(uid)
@@ -266,34 +576,212 @@ class Daemon(object):
     env = os.environ.copy()
     if self.env:
       env.update(self.env)
-    process = subprocess.Popen(command, env=env)
+    if self.timestamps:
+      # Capture the output of the process to timestamp and index it.
+      out = TimestampedLog(self.stdout)
+      err = TimestampedLog(self.stderr) if self.stderr else out
+
+    # Without a probe command, the daemon sends heartbeats as datagrams
+    # to the notify socket.
+    sock = None
+    if self.watchdog and not self.watchdog_probe:
+      sock = self._bind_notify_socket()
+      env['NOCRUX_NOTIFY_SOCKET'] = self.notify_socket
+      env['NOCRUX_WATCHDOG_INTERVAL'] = str(self.watchdog)
+
+    # Discard the stop request of a previous instance.
+    if self.watchdog:
+      try:
+        os.remove(self.stop_file)
+      except OSError:
+        pass
+
+    threads = []
+    restarts = 0
+    failures = 0
+    while True:
+      if self.timestamps:
+        process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE,
+          stderr=subprocess.PIPE)
+        threads += [out.capture(process.stdout), err.capture(process.stderr)]
+      else:
+        process = subprocess.Popen(command, env=env)
+      try:
+        with open(self.pidfile, 'w') as pidf:
+          pidf.write(str(process.pid))
+      except OSError as exc:
+        process.kill()
+        process.wait()
+        self.log('pid file "{0}" could not be created.'.format(self.pidfile), file=sys.stderr)
+        self.log('process killed. error:', exc, file=sys.stderr)
+        break
+
+      # Wait until the process exits or is terminated by the watchdog.
+      if not self._watch(process, sock, restarts):
+        break
+      if os.path.exists(self.stop_file):
+        self.log('stop requested, not restarting', file=sys.stderr)
+        break
+      restarts += 1
+
+      # Back off exponentially while the daemon never sends a heartbeat
+      # at all (eg. because the probe command is broken).
+      failures = 0 if self._heartbeat_seen else failures + 1
+      if failures:
+        delay = min(self.watchdog * 2 ** (failures - 1), config['watchdog_max_backoff'])
+        self.log('no heartbeat since the daemon was started, restarting in {:g} seconds ...'
+          .format(delay), file=sys.stderr)
+        tstart = time.time()
+        while time.time() - tstart < delay and not os.path.exists(self.stop_file):
+          time.sleep(min(0.5, delay))
+        if os.path.exists(self.stop_file):
+          self.log('stop requested, not restarting', file=sys.stderr)
+          break
+      else:
+        self.log('restarting ...', file=sys.stderr)
+
+    # Remove the pid file before anything else, unless it already belongs
+    # to a new instance of the daemon (eg. during a restart).
+    if self.pid == process.pid:
+      try:
+        os.remove(self.pidfile)
+      except OSError:
+        self.log('warning: pid file "{0}" could not be removed'.format(self.pidfile), file=sys.stderr)
+
+    # The watchdog files may already belong to a new supervisor as well.
+    if self.watchdog:
+      self._remove_watchdog_files(sock)
+
+    # Child processes of the daemon may still hold the output pipes open,
+    # so we don't wait forever for the capture threads to finish.
+    for thread in threads:
+      thread.join(1.0)
+    self.log('terminated. exit code: {0}'.format(process.returncode), file=sys.stderr)
+    sys.exit(0)
+
+  def _bind_notify_socket(self):
+    ''' Creates the datagram socket that the daemon sends heartbeats to. '''
+
+    makedirs(os.path.dirname(self.notify_socket))
     try:
-      with open(self.pidfile, 'w') as pidf:
-        pidf.write(str(process.pid))
+      os.remove(self.notify_socket)
     except OSError as exc:
-      process.kill()
-      process.wait()
-      self.log('pid file "{0}" could not be created.'.format(self.pidfile), file=sys.stderr)
-      self.log('process killed. error:', exc, file=sys.stderr)
+      if exc.errno != errno.ENOENT:
+        raise
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(self.notify_socket)
+    self._notify_inode = os.stat(self.notify_socket).st_ino
+    return sock
+
+  def _remove_watchdog_files(self, sock):
+    ''' Removes the watchdog state file and the notify socket *sock* if
+    they have not been replaced by another supervisor in the meantime. '''
 
-    # Wait until the process exits to delete the pidfile.
-    process.wait()
-    self.log('terminated. exit code: {0}'.format(process.returncode), file=sys.stderr)
     try:
-      os.remove(self.pidfile)
+      with open(self.watchdog_file, 'r') as fp:
+        parts = fp.readline().split()
+      if parts[2:] == [str(os.getpid())]:
+        os.remove(self.watchdog_file)
     except OSError:
-      self.log('warning: pid file "{0}" could not be removed'.format(self.pidfile), file=sys.stderr)
-    sys.exit(0)
+      pass
+    if sock is not None:
+      try:
+        if os.stat(self.notify_socket).st_ino == self._notify_inode:
+          os.remove(self.notify_socket)
+      except OSError:
+        pass
+      sock.close()
+
+  def _probe(self):
+    ''' Runs the :attr:`watchdog_probe` command and returns True if it
+    succeeded within the watchdog interval. '''
+
+    try:
+      returncode = subprocess.call(self.watchdog_probe, shell=True,
+        env=self.command_env(), stdout=subprocess.DEVNULL, timeout=self.watchdog)
+    except subprocess.TimeoutExpired:
+      return False
+    return returncode == 0
+
+  def _watch(self, process, sock, restarts):
+    ''' Waits until *process* exits. If the :attr:`watchdog` is enabled,
+    checks for a heartbeat from the daemon every interval and terminates
+    the process if ``config['watchdog_misses']`` heartbeats in a row are
+    missing. Returns True if the process was terminated by the watchdog.
+    Sets :attr:`_heartbeat_seen` if the daemon sent any heartbeat. '''
+
+    if not self.watchdog:
+      process.wait()
+      return False
+
+    missed = 0
+    self._heartbeat_seen = False
+    self._write_watchdog_state(missed, restarts)
+    deadline = time.time() + self.watchdog
+    alive = False
+    while process.poll() is None:
+      timeout = max(0, min(0.5, deadline - time.time()))
+      if sock is not None:
+        if select.select([sock], [], [], timeout)[0]:
+          sock.recv(1024)
+          alive = True
+      else:
+        time.sleep(timeout)
+      if time.time() < deadline:
+        continue
+      deadline = time.time() + self.watchdog
+
+      # Leave it to :meth:`stop` to terminate the process.
+      if os.path.exists(self.stop_file):
+        continue
+
+      if self.watchdog_probe:
+        alive = self._probe()
+      if alive:
+        self._heartbeat_seen = True
+        if missed:
+          missed = 0
+          self._write_watchdog_state(missed, restarts)
+      else:
+        missed += 1
+        self._write_watchdog_state(missed, restarts)
+        self.log('missed heartbeat ({})'.format(missed), file=sys.stderr)
+      alive = False
+
+      if missed >= config['watchdog_misses'] and process.poll() is None:
+        self.log('heartbeat lost, terminating ...', file=sys.stderr)
+        process.send_signal(self.sigterm)
+        try:
+          process.wait(config['kill_timeout'])
+        except subprocess.TimeoutExpired:
+          self.log('killing ...', file=sys.stderr)
+          process.send_signal(self.sigkill)
+          process.wait()
+        return True
+
+    return False
+
+  def _write_watchdog_state(self, missed, restarts):
+    # The PID of the supervisor identifies the owner of the file.
+    with open(self.watchdog_file, 'w') as fp:
+      fp.write('{} {} {}\n'.format(missed, restarts, os.getpid()))
 
   def stop(self):
     ''' Stop the daemon if it is running. Sends :attr:`sigterm` first, then
     waits at maximum ``config['kill_timeout']`` seconds and sends
-    :attr`sigkill` if the process hasn't terminated by then. '''
+    :attr`sigkill` if the process hasn't terminated by then. Returns
+    True if the daemon is not running anymore, False otherwise. '''
+
+    # Ask the supervisor not to restart the daemon with the watchdog.
+    if self.watchdog:
+      makedirs(os.path.dirname(self.stop_file))
+      with open(self.stop_file, 'w'):
+        pass
 
     pid = self.pid
     if pid == 0:
       self.log('daemon not running')
-      return
+      return True
 
     try:
       os.kill(pid, self.sigterm)
@@ -309,6 +797,10 @@ class Daemon(object):
         self.log('killing...')
         try: os.kill(pid, self.sigkill)
         except OSError: pass
+        # Give the supervisor a moment to reap the process.
+        tstart = time.time()
+        while time.time() - tstart < config['kill_timeout'] and process_exists(pid):
+          time.sleep(0.1)
         if process_exists(pid):
           self.log('failed')
         else:
@@ -316,6 +808,20 @@ class Daemon(object):
       else:
         self.log('done')
 
+    # The watchdog may have restarted the daemon before the stop request.
+    if self.watchdog and self.pid not in (0, pid) and process_exists(self.pid):
+      return self.stop()
+
+    # Resume supervision if the daemon is still running.
+    if process_exists(pid):
+      if self.watchdog:
+        try:
+          os.remove(self.stop_file)
+        except OSError:
+          pass
+      return False
+    return True
+
 
 class ConfigParser(object):
 
@@ -382,6 +888,14 @@ def load_config(filename=None):
       config['root'] = value
     elif key == 'kill_timeout':
       config['kill_timeout'] = int(value.strip())
+    elif key == 'watchdog_misses':
+      config['watchdog_misses'] = int(value.strip())
+      if config['watchdog_misses'] < 1:
+        raise ValueError('watchdog_misses must be at least 1')
+    elif key == 'watchdog_max_backoff':
+      config['watchdog_max_backoff'] = float(value.strip())
+      if config['watchdog_max_backoff'] < 0:
+        raise ValueError('watchdog_max_backoff must not be negative')
     else:
       raise ValueError('unexpected config key: {}'.format(key))
 
@@ -439,6 +953,19 @@ def load_config(filename=None):
         params['commands'][cmdname] = cmd
       elif key == 'root':
         params['root'] = value.strip()
+      elif key == 'timestamps':
+        if value.strip() not in ('on', 'off'):
+          raise ValueError('daemon {}: invalid timestamps field: {!r}'.format(name, value))
+        params['timestamps'] = (value.strip() == 'on')
+      elif key == 'watchdog':
+        interval, __, probe = map(str.strip, value.strip().partition(' '))
+        try:
+          params['watchdog'] = float(interval)
+        except ValueError:
+          raise ValueError('daemon {}: invalid watchdog interval: {!r}'.format(name, interval))
+        if params['watchdog'] <= 0:
+          raise ValueError('daemon {}: watchdog interval must be positive'.format(name))
+        params['watchdog_probe'] = probe or None
       else:
         raise ValueError('daemon {}: unexpected config key: {}'.format(name, item))
     daemons[name] = Daemon(**params)
@@ -446,6 +973,114 @@ def load_config(filename=None):
   return True
 
 
+# The result of an operation on a daemon through the Python API. *ok* is
+# the return value of the operation, *status*, *pid* and *watchdog* (None
+# if the daemon has no watchdog) reflect the state after the operation and
+# *messages* is a list of the ``(name, message)`` pairs the daemons logged.
+Result = collections.namedtuple('Result', 'name ok status pid watchdog messages')
+
+
+def resolve_daemons(selection):
+  ''' Returns a list of the daemons in *selection*, which can be a
+  :class:`Daemon`, a selector string as accepted by :func:`select_daemons`
+  or an iterable of these. '''
+
+  if isinstance(selection, (str, Daemon)):
+    selection = [selection]
+  result = []
+  for item in selection:
+    items = select_daemons(item) if isinstance(item, str) else [item]
+    result.extend(x for x in items if x not in result)
+  return result
+
+
+def run_operation(daemon, operation):
+  ''' Runs *operation* (``start``, ``stop``, ``restart`` or ``status``) on
+  *daemon* without printing any messages and returns a :class:`Result`. '''
+
+  if operation not in ('start', 'stop', 'restart', 'status'):
+    raise ValueError('invalid operation: {!r}'.format(operation))
+
+  messages = []
+  previous = getattr(log_capture, 'messages', None)
+  log_capture.messages = messages
+  try:
+    if operation == 'start':
+      ok = daemon.start()
+    elif operation == 'stop':
+      ok = daemon.stop()
+    elif operation == 'restart':
+      ok = daemon.stop() and daemon.start()
+    else:
+      ok = True
+  finally:
+    log_capture.messages = previous
+
+  status = daemon.status
+  pid = daemon.pid if status == Daemon.Status_Started else 0
+  watchdog = daemon.watchdog_state if daemon.watchdog else None
+  return Result(daemon.name, ok, status, pid, watchdog, messages)
+
+
+async def run_operation_async(operation, selection, executor=None):
+  ''' Runs *operation* on all daemons in *selection* concurrently in the
+  *executor* of the running event loop. Returns the list of :class:`Result`
+  objects, in the order of the selected daemons. '''
+
+  loop = asyncio.get_running_loop()
+  return await asyncio.gather(*[
+    loop.run_in_executor(executor, run_operation, daemon, operation)
+    for daemon in resolve_daemons(selection)])
+
+
+def start(selection):
+  ''' Starts the daemons in *selection* and returns a list of results. '''
+
+  return [run_operation(d, 'start') for d in resolve_daemons(selection)]
+
+
+def stop(selection):
+  ''' Stops the daemons in *selection* and returns a list of results. '''
+
+  return [run_operation(d, 'stop') for d in resolve_daemons(selection)]
+
+
+def restart(selection):
+  ''' Restarts the daemons in *selection* and returns a list of results. '''
+
+  return [run_operation(d, 'restart') for d in resolve_daemons(selection)]
+
+
+def status(selection):
+  ''' Returns a list of results with the status of the daemons in *selection*. '''
+
+  return [run_operation(d, 'status') for d in resolve_daemons(selection)]
+
+
+async def start_async(selection, executor=None):
+  ''' Asynchronous version of :func:`start`. '''
+
+  return await run_operation_async('start', selection, executor)
+
+
+async def stop_async(selection, executor=None):
+  ''' Asynchronous version of :func:`stop`. '''
+
+  return await run_operation_async('stop', selection, executor)
+
+
+async def restart_async(selection, executor=None):
+  ''' Asynchronous version of :func:`restart`. '''
+
+  return await run_operation_async('restart', selection, executor)
+
+
+async def status_async(selection, executor=None):
+  ''' Asynchronous version of :func:`status`. '''
+
+  return await run_operation_async('status', selection, executor)
+
+
 def reindent(text, indent):
   lines = textwrap.dedent(text).split('\n')
   while lines and not lines[0].strip():
@@ -455,6 +1090,38 @@ def reindent(text, indent):
   return indent + ('\n' + indent).join(lines)
 
 
+def run_supervisor(fp):
+  ''' Entry point of the supervisor process started by :meth:`Daemon.start`.
+  Reads the daemon and the configuration from *fp* and forks, so that the
+  daemon is not a child of the process that started it. '''
+
+  state, conf, pythonpath, home, uid, gid = pickle.load(fp)
+  config.update(conf)
+  if pythonpath is None:
+    os.environ.pop('PYTHONPATH', None)
+  else:
+    os.environ['PYTHONPATH'] = pythonpath
+  # Daemon instances are not pickled directly, as this script runs as
+  # the __main__ module and would otherwise import a second copy of itself.
+  daemon = Daemon.__new__(Daemon)
+  daemon.__setstate__(state)
+  if os.fork() > 0:
+    return 0
+  daemon._run(home, uid, gid)
+
+
+def format_status(daemon):
+  ''' Returns the status of *daemon* for display, including the watchdog
+  state if the daemon has a watchdog and is running. '''
+
+  status = daemon.status
+  if daemon.watchdog and status == Daemon.Status_Started:
+    state = daemon.watchdog_state
+    status += ' (missed heartbeats: {}, watchdog restarts: {})'.format(
+      state.missed, state.restarts)
+  return status
+
+
 def rerun_with_sudo(args):
   assert args.sudo or args.as_
   sudo_argv = ['sudo']
@@ -468,6 +1135,9 @@ def rerun_with_sudo(args):
   if args.list: sudo_argv.append('--list')
   if args.follow: sudo_argv.append('--follow')
   if args.stderr: sudo_argv.append('--stderr')
+  if args.since: sudo_argv.extend(['--since', args.since])
+  if args.until: sudo_argv.extend(['--until', args.until])
+  if args.grep: sudo_argv.extend(['--grep', args.grep])
   if args.version: sudo_argv.append('--version')
   print('$', ' '.join(map(shlex.quote, sudo_argv)))
   return subprocess.call(sudo_argv)
@@ -488,6 +1158,8 @@ def main(argv=None):
 
         root ~/.nocrux/run;
         kill_timeout 10;
+        watchdog_misses 3;
+        watchdog_max_backoff 300;
 
     You can also include other files like this (relative paths are considered
     relative to the configuration file):
@@ -517,6 +1189,29 @@ def main(argv=None):
       - pid
       - cat
       - tail
+      - logs
+
+    With the `timestamps on;` option, nocrux prefixes every line of the
+    daemon's output with a timestamp and maintains an index next to the
+    output file. The `logs` command searches these logs for a time range
+    and merges the lines of multiple daemons in time order. The daemon name
+    can be a comma separated list of names or glob patterns, or `all`:
+
+        $ nocrux jupyter,web logs --since 10m --grep ERROR
+
+    With the `watchdog <interval>;` option, the daemon must send a heartbeat
+    at least every <interval> seconds by sending a datagram to the Unix
+    socket in $NOCRUX_NOTIFY_SOCKET. Alternatively, a probe command can be
+    specified that is run every interval and must exit with status 0:
+
+        watchdog 30 curl -sf http://localhost:8888/;
+
+    After `watchdog_misses` missed heartbeats in a row, nocrux terminates
+    the daemon with its term and kill signals and restarts it. If the daemon
+    did not send a single heartbeat since it was last restarted, nocrux waits
+    before restarting it again, starting with the watchdog interval and
+    doubling with every restart up to `watchdog_max_backoff` seconds. The
+    `status` command shows the number of missed heartbeats and restarts.
 
     You can specify additional commands like this:
 
@@ -542,6 +1237,7 @@ def main(argv=None):
           cwd ~;
           command uptime echo $(($(date +%s) - $(date +%s -r $DAEMON_PIDFILE))) seconds;
           requires daemon1 daemon2;
+          watchdog 30;
 
           # Options with their respective defaults:
           user me;
@@ -552,6 +1248,7 @@ def main(argv=None):
           pidfile $root/$name.pid;
           signal term TERM;
           signal kill KILL;
+          timestamps off;
         }
     """, indent='  '),
     formatter_class=argparse.RawDescriptionHelpFormatter
@@ -564,12 +1261,19 @@ def main(argv=None):
   parser.add_argument('--sudo', action='store_true', help='Re-invoke the same command with sudo.')
   parser.add_argument('--as', dest='as_', help='Run the command as the specified user. Overrides --sudo.')
   parser.add_argument('--stderr', action='store_true', help='Choose stderr instead of stdout for the cat/tail command.')
+  parser.add_argument('--since', help='Show only log lines since this time (eg. 10m or "2017-05-01 12:00").')
+  parser.add_argument('--until', help='Show only log lines before this time.')
+  parser.add_argument('--grep', metavar='PATTERN', help='Show only log lines matching this regular expression.')
   parser.add_argument('--version', action='store_true', help='Print the nocrux version and exit.')
+  parser.add_argument('--supervise', action='store_true', help=argparse.SUPPRESS)
   args = parser.parse_args(argv)
   def fail(msg, code=1):
     print(msg, file=sys.stderr)
     sys.exit(code)
 
+  if args.supervise:
+    return run_supervisor(sys.stdin.buffer)
+
   if (not args.daemon or not args.command) and (args.sudo or args.as_):
     return rerun_with_sudo(args)
 
@@ -584,7 +1288,7 @@ def main(argv=None):
   if args.list:
     load_config()
     for daemon in sorted(daemons.values(), key=attrgetter('name')):
-      daemon.log(daemon.status)
+      daemon.log(format_status(daemon))
     return 0
 
   if not args.daemon:
@@ -593,6 +1297,33 @@ def main(argv=None):
     fail('specify a command name')
 
   load_config()
+  if args.command == 'logs':
+    try:
+      selected = select_daemons(args.daemon)
+      since = parse_time(args.since) if args.since else None
+      until = parse_time(args.until) if args.until else None
+      pattern = re.compile(args.grep) if args.grep else None
+    except (ValueError, re.error) as exc:
+      fail(exc)
+
+    # Like for the other commands, read the logs as the daemon's user if
+    # all selected daemons run as the same user.
+    users = set(d.user for d in selected)
+    if len(users) == 1 and not args.as_:
+      args.as_ = users.pop()
+    if args.sudo or (args.as_ and os.getenv('NOCRUX_AS') != args.as_):
+      return rerun_with_sudo(args)
+
+    for d in selected:
+      if not d.timestamps:
+        d.log('timestamps are not enabled, skipping', file=sys.stderr)
+    try:
+      for stamp, label, line in search_logs(selected, since, until, pattern):
+        print(stamp, '({})'.format(label), line)
+    except KeyboardInterrupt:
+      return 2
+    return 0
+
   if args.daemon not in daemons:
     fail('no such daemon: {}'.format(args.daemon))
   d = daemons[args.daemon]
@@ -612,7 +1343,7 @@ def main(argv=None):
     d.stop()
     d.start()
   elif args.command == 'status':
-    d.log(d.status)
+    d.log(format_status(d))
   elif args.command == 'pid':
     print(d.pid)
   elif args.command in ('cat', 'tail'):
@@ -627,15 +1358,9 @@ def main(argv=None):
       return 2
   else:
     if args.command in d.commands:
-      env = os.environ.copy()
-      env.update(d.env)
-      env['DAEMON_PID'] = str(d.pid)
-      env['DAEMON_PIDFILE'] = d.pidfile
-      env['DAEMON_STDOUT'] = d.stdout
-      env['DAEMON_STDERR'] = d.stderr or ''
       try:
         cmd = d.commands[args.command]
-        return subprocess.call(cmd, shell=True, env=env)
+        return subprocess.call(cmd, shell=True, env=d.command_env())
       except KeyboardInterrupt:
         return 2
     fail('invalid command: {}'.format(args.command))